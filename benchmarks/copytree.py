@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#  Compares clone_tree() with shutil.copytree() on a data directory
+#  which contains many small files.
+#
+#  Usage: python benchmarks/copytree.py [--files 20000] [--size 4096] [--workers 1,4,8,16]
+
+import os
+import sys
+import argparse
+import tempfile
+from time import time
+from shutil import copytree, rmtree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from testing.common.database import clone_tree  # noqa: E402
+
+
+def make_datadir(path, files, size, files_per_dir=500):
+    payload = os.urandom(size)
+    for i in range(files):
+        dirname = os.path.join(path, 'base', str(i // files_per_dir))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, str(i)), 'wb') as fp:
+            fp.write(payload)
+
+
+def measure(func, src, workdir, repeat):
+    results = []
+    for i in range(repeat):
+        dst = os.path.join(workdir, 'dst')
+        started_at = time()
+        func(src, dst)
+        results.append(time() - started_at)
+        rmtree(dst)
+
+    return min(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark clone_tree() against shutil.copytree()')
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--workers', default='1,4,8,16')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dir', default=None, help='working directory (default: $TMPDIR)')
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=options.dir)
+    try:
+        src = os.path.join(workdir, 'src')
+        make_datadir(src, options.files, options.size)
+        print('%d files x %d bytes' % (options.files, options.size))
+
+        elapsed = measure(copytree, src, workdir, options.repeat)
+        print('%-28s %8.3f sec' % ('shutil.copytree', elapsed))
+        baseline = elapsed
+
+        for workers in [int(n) for n in options.workers.split(',')]:
+            for strategy in ('copy', 'auto'):
+                def func(src, dst):
+                    clone_tree(src, dst, strategy, workers)
+
+                elapsed = measure(func, src, workdir, options.repeat)
+                name = 'clone_tree(%s, workers=%d)' % (strategy, workers)
+                print('%-28s %8.3f sec (x%.2f)' % (name, elapsed, baseline / elapsed))
+    finally:
+        rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#  Benchmarks for the lifecycle of Database with a stub server (runs offline).
+#
+#  Usage: python benchmarks/lifecycle.py [--repeat 5] [--output report.json] [--compare base.json]
+
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+from time import time
+from shutil import rmtree
+
+sys.path.insert(0, os.path.dirname(__file__))
+from stubserver import StubDatabase, StubDatabaseFactory  # noqa: E402
+
+
+def measure(func, repeat):
+    results = []
+    for _ in range(repeat):
+        started_at = time()
+        func()
+        results.append(time() - started_at)
+
+    results.sort()
+    return {'min': results[0], 'median': results[len(results) // 2], 'max': results[-1]}
+
+
+def bench_cold_boot(repeat):
+    return measure(lambda: StubDatabase().stop(), repeat)
+
+
+def bench_cached_boot(repeat):
+    factory = StubDatabaseFactory(cache_initialized_db=True)
+    try:
+        return measure(lambda: factory().stop(), repeat)
+    finally:
+        factory.clear_cache()
+
+
+def bench_copy_data_from(repeat, sizes):
+    results = {}
+    for files in sizes:
+        datadir = tempfile.mkdtemp()
+        try:
+            payload = os.urandom(8192)
+            for i in range(files):
+                dirname = os.path.join(datadir, 'base', str(i // 500))
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                with open(os.path.join(dirname, str(i)), 'wb') as fp:
+                    fp.write(payload)
+
+            results['%d files' % files] = measure(lambda: StubDatabase(copy_data_from=datadir).stop(), repeat)
+        finally:
+            rmtree(datadir, ignore_errors=True)
+
+    return results
+
+
+def bench_terminate(repeat):
+    def terminate():
+        database = StubDatabase()
+        started_at = time()
+        database.terminate()
+        elapsed = time() - started_at
+        database.cleanup()
+        return elapsed
+
+    results = sorted(terminate() for _ in range(repeat))
+    return {'min': results[0], 'median': results[len(results) // 2], 'max': results[-1]}
+
+
+def bench_concurrent_boot(repeat, concurrency):
+    factory = StubDatabaseFactory(cache_initialized_db=True)
+    results = {}
+    try:
+        for n in concurrency:
+            def boot():
+                for database in factory.spawn_many(n):
+                    database.stop()
+
+            results['%d instances' % n] = measure(boot, repeat)
+    finally:
+        factory.clear_cache()
+
+    return results
+
+
+def get_version():
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=cwd).strip().decode()
+    except Exception:
+        return 'unknown'
+
+
+def flatten(report, prefix=''):
+    for key, value in sorted(report.items()):
+        if isinstance(value, dict) and 'median' in value:
+            yield prefix + key, value['median']
+        elif isinstance(value, dict):
+            for item in flatten(value, prefix + key + ' / '):
+                yield item
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the lifecycle of Database with a stub server')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--sizes', default='100,1000,10000', help='number of files in copy_data_from')
+    parser.add_argument('--concurrency', default='1,2,4,8')
+    parser.add_argument('--output', help='write the report as JSON')
+    parser.add_argument('--compare', help='compare with the report written by --output')
+    options = parser.parse_args()
+
+    report = {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': {
+            'cold boot': bench_cold_boot(options.repeat),
+            'cached boot': bench_cached_boot(options.repeat),
+            'copy_data_from': bench_copy_data_from(options.repeat, [int(n) for n in options.sizes.split(',')]),
+            'terminate': bench_terminate(options.repeat),
+            'concurrent boot': bench_concurrent_boot(options.repeat,
+                                                     [int(n) for n in options.concurrency.split(',')]),
+        }
+    }
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as fp:
+            base = json.load(fp)
+            baseline = dict(flatten(base['results']))
+            print('compared with %s' % base['version'])
+
+    print('%-40s %10s' % ('benchmark (version: %s)' % report['version'], 'median'))
+    for name, median in flatten(report['results']):
+        line = '%-40s %9.4fs' % (name, median)
+        if name in baseline:
+            line += ' (%+.1f%%)' % ((median - baseline[name]) / baseline[name] * 100)
+        print(line)
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
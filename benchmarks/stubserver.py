@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#  A tiny fake database server for benchmarks.
+#  The "server" is a Python process listening on a TCP port (or a Unix socket).
+
+import os
+import sys
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from testing.common.database import Database, DatabaseFactory  # noqa: E402
+
+SERVER_SCRIPT = '''
+import os, sys, socket, signal
+signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+address = sys.argv[1]
+if address.isdigit():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", int(address)))
+else:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+sock.listen(128)
+sys.stdout.write("ready to accept connections\\n")
+sys.stdout.flush()
+while True:
+    conn, _ = sock.accept()
+    conn.close()
+'''
+
+
+class StubDatabase(Database):
+    DEFAULT_SETTINGS = dict(auto_start=2,
+                            base_dir=None,
+                            port=None,
+                            copy_data_from=None)
+    subdirectories = ['data', 'tmp']
+
+    def get_data_directory(self):
+        return os.path.join(self.base_dir, 'data')
+
+    def initialize_database(self):
+        path = os.path.join(self.get_data_directory(), 'VERSION')
+        if not os.path.exists(path):
+            with open(path, 'w') as fp:
+                fp.write('1\n')
+
+    def get_server_commandline(self):
+        address = self.socket_path or str(self.settings['port'])
+        return [sys.executable, '-S', '-c', SERVER_SCRIPT, address]
+
+    def is_server_available(self):
+        try:
+            if self.socket_path:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.socket_path)
+            else:
+                sock = socket.create_connection(('127.0.0.1', self.settings['port']), timeout=1.0)
+            sock.close()
+            return True
+        except socket.error:
+            return False
+
+
+class StubDatabaseFactory(DatabaseFactory):
+    target_class = StubDatabase
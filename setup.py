@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import sys
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 
 classifiers = [
     "Development Status :: 4 - Beta",
@@ -23,6 +24,16 @@ if sys.version_info < (2, 7):
     install_requires.append('unittest2')
 
 
+class BuildPy(build_py):
+    # testing.common.aiodatabase requires Python 3.5+ (async/await syntax);
+    # do not install (and byte-compile) it on older interpreters
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            modules = [m for m in modules if m[:2] != ('testing.common', 'aiodatabase')]
+        return modules
+
+
 setup(
     name='testing.common.database',
     version='2.0.2',
@@ -39,6 +50,7 @@ setup(
     package_data={'': ['buildout.cfg']},
     include_package_data=True,
     install_requires=install_requires,
+    cmdclass={'build_py': BuildPy},
     extras_require=dict(
         testing=[
             'nose',
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#  Copyright 2013 Takeshi KOMIYA
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# asyncio interfaces for testing.common.database (Python 3.5+)
+
+import os
+import signal
+import asyncio
+import subprocess
+from time import sleep
+
+from testing.common.database import (Backoff, DatabaseFactory, Deadline, ReadinessWatcher, clock, get_popen_options,
+                                     kill_process)
+
+
+class AsyncProcess(object):
+    # Popen compatible wrapper of asyncio.subprocess.Process.
+    # The child watcher of the event loop reaps the process; the synchronous interfaces
+    # (poll(), wait()) only peek its exit status (WNOWAIT) not to race with the watcher.
+
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+        self._returncode = None
+
+    @property
+    def returncode(self):
+        if self.process.returncode is not None:
+            return self.process.returncode
+        else:
+            return self._returncode
+
+    def poll(self):
+        if self.returncode is None and hasattr(os, 'waitid'):
+            try:
+                result = os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+                if result:
+                    if result.si_code == os.CLD_EXITED:
+                        self._returncode = result.si_status
+                    else:
+                        self._returncode = -result.si_status
+            except ChildProcessError:
+                # reaped by the child watcher, but the event loop has not received the status yet;
+                # regard it as 0 like subprocess.Popen does until the loop sets the real one
+                self._returncode = 0
+
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = Deadline(timeout)
+        for interval in Backoff():
+            if self.poll() is not None:
+                return self.returncode
+            elif deadline.expired():
+                raise subprocess.TimeoutExpired(self.pid, timeout)
+
+            sleep(deadline.cap(interval))
+
+    async def wait_async(self, timeout):
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def send_signal(self, _signal):
+        self.process.send_signal(_signal)
+
+    def terminate(self):
+        self.process.terminate()
+
+    def kill(self):
+        self.process.kill()
+
+
+async def create(target_class, **settings):
+    db = target_class(**dict(settings, auto_start=0))
+    auto_start = settings.get('auto_start', db.DEFAULT_SETTINGS.get('auto_start'))
+    db.settings['auto_start'] = auto_start
+    try:
+        if auto_start:
+            if auto_start >= 2:
+                await run_in_executor(db.setup)
+
+            await start(db)
+    except Exception:
+        db.cleanup()
+        raise
+
+    return db
+
+
+async def start(db):
+    db._pending_start = False
+    if db.child_process:
+        return  # already started
+
+    await spawn(db)
+    await wait_started(db)
+
+
+async def spawn(db):
+    if db.log_hooks:
+        raise RuntimeError('log_hooks is not supported by the asyncio interfaces: %s' % db.name)
+
+    with db.timing('prestart'):
+        db.prestart()
+
+    db.log_capture = None  # capture_log and log_hooks are not supported; the output is written into the log file
+    logger = open(os.path.join(db.base_dir, '%s.log' % db.name), 'wt')
+    try:
+        db._spawned_at = clock()
+        command = db.get_server_commandline()
+        with db.timing('spawn'):
+            process = await asyncio.create_subprocess_exec(*command, stdout=logger, stderr=logger,
+                                                           **get_popen_options())
+        db.child_process = AsyncProcess(process)
+        db.register_process()
+    except Exception as exc:
+        db.release_port()
+        db.record_boot(failed=True)
+        raise RuntimeError('failed to launch %s: %r' % (db.name, exc))
+    finally:
+        logger.close()
+
+
+async def wait_started(db):
+    retries = db.settings.get('port_retries', db.DEFAULT_PORT_RETRIES)
+    try:
+        while True:
+            try:
+                with db.timing('readiness'):
+                    await wait_booting(db)
+                break
+            except RuntimeError:
+                if retries <= 0 or not db.is_port_collided():
+                    raise
+
+            # another process took the port; retry with a new one
+            retries -= 1
+            await terminate(db)
+            db.release_port()
+            db.settings['port'] = None
+            await spawn(db)
+
+        with db.timing('poststart'):
+            await run_in_executor(db.poststart)
+    except Exception:
+        db.record_boot(failed=True)
+        await stop(db)
+        raise
+    finally:
+        db.release_port()
+
+    db.record_boot()
+
+
+async def wait_booting(db):
+    boot_timeout = db.settings.get('boot_timeout', db.DEFAULT_BOOT_TIMEOUT)
+    backoff = Backoff(maximum=db.settings.get('boot_poll_interval', db.DEFAULT_BOOT_POLL_INTERVAL))
+    watcher = ReadinessWatcher(os.path.join(db.base_dir, '%s.log' % db.name),
+                               db.settings.get('boot_ready_pattern', db.boot_ready_pattern),
+                               notify=False,
+                               fatal_pattern=db.settings.get('boot_fatal_pattern', db.boot_fatal_pattern))
+    deadline = Deadline(boot_timeout)
+    while True:
+        if db.child_process.returncode is not None:
+            raise RuntimeError("*** failed to launch %s (exit status: %d) ***\n" %
+                               (db.name, db.child_process.returncode) +
+                               db.read_bootlog())
+
+        if watcher.is_ready():
+            break
+
+        if watcher.failure:
+            raise RuntimeError("*** failed to launch %s (%s) ***\n" % (db.name, watcher.failure) +
+                               db.read_bootlog())
+
+        if await probe_server(db):
+            break
+
+        if deadline.expired():
+            raise RuntimeError("*** failed to launch %s (timeout) ***\n" % db.name +
+                               db.read_bootlog())
+
+        await db.child_process.wait_async(deadline.cap(next(backoff)))  # wake up as soon as the server exits
+
+
+async def probe_server(db):
+    if db.settings.get('probe_port', db.probe_port) and not await is_port_listening(db):
+        return False  # skip expensive checks until the server starts listening
+
+    return await run_in_executor(db.is_server_available)
+
+
+async def is_port_listening(db):
+    if db.socket_path:
+        connect = asyncio.open_unix_connection(db.socket_path)
+    else:
+        connect = asyncio.open_connection('localhost', db.settings['port'])
+
+    try:
+        _, writer = await asyncio.wait_for(connect, 1.0)
+        writer.close()
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+
+async def stop(db, _signal=signal.SIGTERM):
+    try:
+        await terminate(db, _signal)
+    finally:
+        await run_in_executor(db.cleanup)
+
+
+async def terminate(db, _signal=None):
+    db._pending_start = False
+    db.release_port()
+    if db.child_process is None:
+        return  # not started
+
+    if db._owner_pid != os.getpid():
+        return  # could not stop in child process
+
+    if not isinstance(db.child_process, AsyncProcess):  # started synchronously
+        return await run_in_executor(db.terminate, _signal)
+
+    strategy, _signal, kill_timeout = db.get_shutdown_options(_signal)
+    process = db.child_process
+    with db.timing('terminate'):
+        try:
+            if strategy == 'immediate':
+                kill_process(process)
+                await process.wait_async(kill_timeout)
+            else:
+                process.send_signal(_signal)
+                if not await process.wait_async(kill_timeout):
+                    kill_process(process)
+                    if strategy == 'graceful':
+                        raise RuntimeError("*** failed to shutdown %s (timeout) ***\n" % db.name +
+                                           db.read_bootlog())
+
+                    await process.wait_async(kill_timeout)
+        except OSError:
+            pass
+
+    db.child_process = None
+
+
+async def enter(db):
+    await start(db)
+    return db
+
+
+async def run_in_executor(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+class AsyncDatabaseFactory(DatabaseFactory):
+    async def __call__(self):
+        if self.released:
+            return self.released.popleft()
+        elif self.pool:
+            return await run_in_executor(self.pool.get)
+        else:
+            return await create(self.target_class, **self.settings)
+
+    async def spawn_many(self, n):
+        results = await asyncio.gather(*(self() for _ in range(n)), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            await asyncio.gather(*(r.astop() for r in results if not isinstance(r, BaseException)))
+            raise errors[0]
+
+        return results
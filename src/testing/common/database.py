@@ -15,59 +15,624 @@
 
 import copy
 import os
+import re
 import sys
+import ctypes
+import errno
+import select
+import getpass
+import hashlib
+import json
+import functools
 import signal
 import socket
 import tempfile
 import subprocess
+import atexit
+import threading
+import weakref
 from time import sleep
-from shutil import copytree, rmtree
-from datetime import datetime
+from shutil import copystat, copyfileobj, rmtree
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+try:
+    from queue import Queue
+except ImportError:  # Python 2.7
+    from Queue import Queue
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import collections
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    from time import monotonic as clock
+except ImportError:  # Python 2.7
+    from time import time as clock
+
+try:
+    string_types = (str, unicode)
+except NameError:  # Python 3
+    string_types = (str,)
+
+try:
+    DEFAULT_COPY_WORKERS = min(8, cpu_count())
+except NotImplementedError:
+    DEFAULT_COPY_WORKERS = 1
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int); see ioctl_ficlone(2)
+CLONE_UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS)
+COPY_BUFSIZE = 8 * 1024 * 1024
+SYS_PIDFD_OPEN = 434  # same number on all architectures (except alpha)
+UNIX_PATH_MAX = 100  # sizeof(sockaddr_un.sun_path) is 104 on BSD, 108 on Linux
+libc = None
+
 
 class DatabaseFactory(object):
+    DEFAULT_MAX_REUSE = 100
+    DEFAULT_SPAWN_WORKERS = 16
     target_class = None
 
+    # settings which do not affect the contents of initialized database
+    volatile_settings = ('auto_start', 'base_dir', 'port', 'unix_socket', 'copy_data_from',
+                         'copy_data_strategy', 'copy_data_workers', 'boot_timeout', 'boot_poll_interval',
+                         'boot_ready_pattern', 'boot_fatal_pattern', 'probe_port', 'port_retries', 'kill_timeout',
+                         'shutdown_strategy', 'background_stop', 'base_dir_placement', 'memory_dir',
+                         'memory_min_free', 'copy_data_size', 'lazy_start', 'on_timing',
+                         'deferred_cleanup', 'capture_log', 'log_tail_lines', 'log_max_bytes',
+                         'log_backup_count', 'log_tail_bytes', 'log_hooks', 'reap_orphans')
+
     def __init__(self, **kwargs):
         self.cache = None
+        self.cache_ref = None
+        self.pool = None
+        self.released = deque()
         self.settings = kwargs
 
         init_handler = self.settings.pop('on_initialized', None)
+        self.reset_handler = self.settings.pop('on_reset', None)
+        self.max_reuse = self.settings.pop('max_reuse', self.DEFAULT_MAX_REUSE)
+        pool_size = self.settings.pop('pool_size', None)
+        pool_max_idle = self.settings.pop('pool_max_idle', None)
+        cache_dir = self.settings.pop('cache_dir', None)
+        cache_fingerprint = self.settings.pop('cache_fingerprint', None)
+        cache_max_size = self.settings.pop('cache_max_size', None)
+        cache_lock_timeout = self.settings.pop('cache_lock_timeout', None)
+        copy_data_size = None
         if self.settings.pop('cache_initialized_db', None):
-            if init_handler:
-                try:
-                    self.cache = self.target_class(**self.settings)
-                    init_handler(self.cache)
-                except Exception:
-                    if self.cache:
-                        self.cache.stop()
-                    raise
-                finally:
-                    if self.cache:
-                        self.cache.terminate()
+            if cache_dir:
+                template_cache = TemplateCache(cache_dir, cache_max_size)
+                key = self.get_cache_key(cache_fingerprint)
+
+                while True:
+                    # keep the entry from eviction while this factory uses it
+                    self.cache_ref = template_cache.lock(key, cache_lock_timeout, shared=True)
+                    data_dir = template_cache.lookup(key)
+                    if data_dir:
+                        copy_data_size = template_cache.get_size(key)
+                        break
+
+                    self.cache_ref.release()
+                    self.cache_ref = None
+
+                    # only one process builds the cache; others wait for it and reuse
+                    with template_cache.lock(key, cache_lock_timeout):
+                        if template_cache.lookup(key) is None:
+                            self.initialize_cache(init_handler)
+                            template_cache.store(key, self.cache.get_data_directory())
+                            self.cache.cleanup()
+                            self.cache = None
             else:
-                settings_noautostart = copy.deepcopy(self.settings)
-                settings_noautostart.update({"auto_start": 0})
-                self.cache = self.target_class(**settings_noautostart)
-                self.cache.setup()
-            self.settings['copy_data_from'] = self.cache.get_data_directory()
+                self.initialize_cache(init_handler)
+                data_dir = self.cache.get_data_directory()
+            self.settings['copy_data_from'] = data_dir
+
+        if self.settings.get('copy_data_from') and self.settings.get('base_dir_placement', 'disk') != 'disk':
+            # measure the size only once; instances check free space of memory_dir with it
+            if copy_data_size is None:
+                copy_data_size = get_tree_size(self.settings['copy_data_from'])
+            self.settings.setdefault('copy_data_size', copy_data_size)
+
+        if pool_size:
+            self.pool = DatabasePool(self.create_instance, pool_size, pool_max_idle)
+
+    def initialize_cache(self, init_handler):
+        if init_handler:
+            try:
+                self.cache = self.target_class(**self.settings)
+                init_handler(self.cache)
+            except Exception:
+                if self.cache:
+                    self.cache.stop()
+                raise
+            finally:
+                if self.cache:
+                    self.cache.terminate()
+        else:
+            settings_noautostart = copy.deepcopy(self.settings)
+            settings_noautostart.update({"auto_start": 0})
+            self.cache = self.target_class(**settings_noautostart)
+            self.cache.setup()
+
+    def get_cache_key(self, fingerprint=None):
+        probe = self.target_class(**dict(self.settings, auto_start=0))
+        try:
+            version = probe.get_server_version()
+        finally:
+            probe.cleanup()
+
+        settings = dict((key, value) for key, value in self.settings.items()
+                        if key not in self.volatile_settings)
+        source = json.dumps({'class': '%s.%s' % (self.target_class.__module__, self.target_class.__name__),
+                             'settings': settings,
+                             'version': version,
+                             'fingerprint': fingerprint}, sort_keys=True, default=repr)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
 
     def __call__(self):
+        try:
+            return self.released.popleft()
+        except IndexError:
+            pass
+
+        if self.pool:
+            return self.pool.get()
+        else:
+            return self.create_instance()
+
+    def release(self, instance):
+        instance.reuse_count += 1
+        if instance.reuse_count >= self.max_reuse or not instance.is_alive():
+            instance.stop()
+            return
+        elif self.reset_handler is None and not instance.settings.get('copy_data_from'):
+            instance.stop()  # no way to reset; discard it
+            return
+
+        try:
+            if self.reset_handler:
+                self.reset_handler(instance)
+            else:
+                instance.reset()
+        except Exception:
+            instance.stop()
+            raise
+
+        if self.pool:
+            self.pool.put(instance)
+        else:
+            self.released.append(instance)
+
+    def create_instance(self):
         return self.target_class(**self.settings)
 
+    def spawn_many(self, n):
+        reused = []
+        while self.released and len(reused) < n:
+            reused.append(self.released.popleft())
+
+        n -= len(reused)
+        if n <= 0:
+            return reused
+        elif self.pool:
+            return reused + [self.pool.get() for _ in range(n)]
+
+        instances = []
+        try:
+            settings = dict(self.settings, auto_start=0)
+            for _ in range(n):
+                instances.append(self.target_class(**settings))
+
+            auto_start = self.settings.get('auto_start', self.target_class.DEFAULT_SETTINGS.get('auto_start'))
+            if auto_start:
+                pool = ThreadPool(min(n, self.DEFAULT_SPAWN_WORKERS))
+                try:
+                    if auto_start >= 2:
+                        pool.map(lambda db: db.setup(), instances)
+
+                    # launch all servers first, and then wait for all of them
+                    for instance in instances:
+                        instance.settings['auto_start'] = auto_start
+                        instance.spawn()
+                    pool.map(lambda db: db.wait_started(), instances)
+                finally:
+                    pool.close()
+                    pool.join()
+        except Exception:
+            for instance in instances:
+                instance.stop()
+            self.released.extendleft(reversed(reused))
+            raise
+
+        return reused + instances
+
     def clear_cache(self):
+        while self.released:
+            self.released.popleft().stop()
+
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+
         if self.cache:
             self.settings['copy_data_from'] = None
             self.cache.cleanup()
 
+        if self.cache_ref:
+            self.settings['copy_data_from'] = None
+            self.cache_ref.release()
+            self.cache_ref = None
+
+
+class DatabasePool(object):
+    def __init__(self, factory, size, max_idle=None):
+        self.factory = factory
+        self.size = size
+        self.max_idle = max_idle
+        self.instances = deque()  # pairs of (instance, pooled_at)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dormant = False
+        self.error = None
+
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+        atexit.register(self.close)
+
+    def get(self):
+        with self.condition:
+            self.dormant = False
+            self.condition.notify_all()
+            while not self.instances:
+                if self.error:
+                    error, self.error = self.error, None
+                    raise error
+                if self.closed:
+                    raise RuntimeError('database pool is already closed')
+
+                self.condition.wait()
+
+            instance, _ = self.instances.popleft()
+            self.condition.notify_all()
+            return instance
+
+    def put(self, instance):
+        with self.condition:
+            if not self.closed:
+                self.instances.append((instance, clock()))
+                self.condition.notify_all()
+                return
+
+        instance.stop()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (self.dormant or self.error or len(self.instances) >= self.size):
+                    if self.max_idle and self.instances:
+                        expired = self.pop_idle_instances()
+                        if expired:
+                            break
+
+                        self.condition.wait(self.max_idle)
+                    else:
+                        self.condition.wait()
+                else:
+                    expired = []
+
+                if self.closed:
+                    return
+
+            # stop idle instances and sleep until next request
+            if expired:
+                for instance in expired:
+                    instance.stop()
+                continue
+
+            try:
+                instance = self.factory()
+            except Exception as exc:
+                with self.condition:
+                    self.error = exc
+                    self.condition.notify_all()
+                continue
+
+            with self.condition:
+                if not self.closed:
+                    self.instances.append((instance, clock()))
+                    self.condition.notify_all()
+                    continue
+
+            instance.stop()
+            return
+
+    def pop_idle_instances(self):
+        expired = []
+        while self.instances and clock() - self.instances[0][1] > self.max_idle:
+            expired.append(self.instances.popleft()[0])
+
+        if expired:
+            self.dormant = True
+
+        return expired
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.worker.join()
+        while self.instances:
+            instance, _ = self.instances.popleft()
+            instance.stop()
+
+
+class Snapshot(object):
+    def __init__(self, path, in_server=False):
+        self.path = path
+        self.in_server = in_server
+
+    def __repr__(self):
+        return '<Snapshot: %s>' % self.path
+
+
+class LifecycleStats(object):
+    def __init__(self):
+        self.phases = OrderedDict()  # phase -> total elapsed seconds
+        self.counts = {}
+
+    def add(self, phase, elapsed):
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def as_dict(self):
+        return dict(self.phases)
+
+    def __repr__(self):
+        phases = ', '.join('%s=%.3f' % (phase, elapsed) for phase, elapsed in self.phases.items())
+        return '<LifecycleStats: %s>' % phases
+
+
+class LifecycleMetrics(object):
+    # process-wide metrics of all Database instances
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.boots = {}
+            self.failed_boots = {}
+            self.boot_seconds = {}  # class -> Histogram
+            self.shutdown_seconds = {}  # class -> Histogram
+            self.phase_seconds = {}  # (class, phase) -> [sum, count]
+            self.copy_bytes = {}
+            self.leaked = {}
+
+    def record_boot(self, database, elapsed, failed=False):
+        with self.lock:
+            if failed:
+                self._increment(self.failed_boots, database.name)
+            else:
+                self._increment(self.boots, database.name)
+                self._observe(self.boot_seconds, database.name, elapsed)
+
+    def record_phase(self, database, phase, elapsed):
+        with self.lock:
+            summary = self.phase_seconds.setdefault((database.name, phase), [0.0, 0])
+            summary[0] += elapsed
+            summary[1] += 1
+            if phase == 'terminate':
+                self._observe(self.shutdown_seconds, database.name, elapsed)
+
+    def record_copy(self, database, size):
+        with self.lock:
+            self._increment(self.copy_bytes, database.name, size)
+
+    def record_leak(self, database):
+        with self.lock:
+            self._increment(self.leaked, database.name)
+
+    def _increment(self, counter, name, value=1):
+        counter[name] = counter.get(name, 0) + value
+
+    def _observe(self, histograms, name, value):
+        histogram = histograms.setdefault(name, {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def as_dict(self):
+        with self.lock:
+            classes = set(self.boots) | set(self.failed_boots) | set(self.copy_bytes) | set(self.leaked)
+            classes |= set(name for name, _ in self.phase_seconds)
+            result = {}
+            for name in sorted(classes):
+                result[name] = {
+                    'boots': self.boots.get(name, 0),
+                    'failed_boots': self.failed_boots.get(name, 0),
+                    'boot_seconds': copy.deepcopy(self.boot_seconds.get(name)),
+                    'shutdown_seconds': copy.deepcopy(self.shutdown_seconds.get(name)),
+                    'phase_seconds': dict((phase, {'sum': value[0], 'count': value[1]})
+                                          for (_name, phase), value in self.phase_seconds.items()
+                                          if _name == name),
+                    'copy_bytes': self.copy_bytes.get(name, 0),
+                    'leaked': self.leaked.get(name, 0),
+                }
+
+            return {'buckets': [str(bound) for bound in self.BUCKETS], 'classes': result}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        lines = []
+
+        def metric(name, _type, samples):
+            lines.append('# TYPE testing_database_%s %s' % (name, _type))
+            for suffix, labels, value in samples:
+                label = ','.join('%s="%s"' % pair for pair in labels)
+                lines.append('testing_database_%s%s{%s} %s' % (name, suffix, label, value))
+
+        def histogram(name, histograms):
+            samples = []
+            for cls, data in sorted(histograms.items()):
+                for bound, count in zip(self.BUCKETS, data['buckets']):
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('_bucket', [('class', cls), ('le', le)], count))
+                samples.append(('_sum', [('class', cls)], repr(data['sum'])))
+                samples.append(('_count', [('class', cls)], data['count']))
+            metric(name, 'histogram', samples)
+
+        with self.lock:
+            metric('boots_total', 'counter', [('', [('class', c)], v) for c, v in sorted(self.boots.items())])
+            metric('failed_boots_total', 'counter',
+                   [('', [('class', c)], v) for c, v in sorted(self.failed_boots.items())])
+            histogram('boot_seconds', self.boot_seconds)
+            histogram('shutdown_seconds', self.shutdown_seconds)
+            metric('phase_seconds', 'summary',
+                   sum([[('_sum', [('class', c), ('phase', p)], repr(v[0])),
+                         ('_count', [('class', c), ('phase', p)], v[1])]
+                        for (c, p), v in sorted(self.phase_seconds.items())], []))
+            metric('copy_bytes_total', 'counter',
+                   [('', [('class', c)], v) for c, v in sorted(self.copy_bytes.items())])
+            metric('leaked_instances_total', 'counter',
+                   [('', [('class', c)], v) for c, v in sorted(self.leaked.items())])
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        if path.endswith('.json'):
+            content = self.to_json()
+        else:
+            content = self.to_prometheus()
+
+        with open(path, 'w') as fp:
+            fp.write(content)
+
+
+metrics = LifecycleMetrics()
+if os.environ.get('TESTING_DATABASE_METRICS'):
+    atexit.register(lambda: metrics.dump(os.environ['TESTING_DATABASE_METRICS']))
+
+
+class TemplateCache(object):
+    # Persistent cache of initialized data directories:
+    #
+    #   <cache_dir>/<key>/data   ... copy of the data directory
+    #   <cache_dir>/<key>/READY  ... marker (the mtime is used for LRU eviction)
+    #   <cache_dir>/<key>.lock   ... exclusively locked while building or evicting the entry,
+    #                                and shared-locked by factories using the entry
+
+    def __init__(self, cache_dir, max_size=None):
+        if cache_dir is True:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            cache_dir = os.path.join(cache_home, 'testing.common.database')
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def lock(self, key, timeout=None, shared=False):
+        lock = FileLock(os.path.join(self.cache_dir, '%s.lock' % key))
+        if not lock.acquire(timeout=timeout, shared=shared):
+            raise RuntimeError('timed out waiting for another process builds the cache: %s' % key)
+
+        return lock
+
+    def lookup(self, key):
+        path = os.path.join(self.cache_dir, key)
+        try:
+            os.utime(os.path.join(path, 'READY'), None)
+            return os.path.join(path, 'data')
+        except OSError:
+            return None
+
+    def get_size(self, key):
+        try:
+            with open(os.path.join(self.cache_dir, key, 'READY')) as fp:
+                return int(fp.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, key, data_dir):
+        path = os.path.join(self.cache_dir, key)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            clone_tree(data_dir, os.path.join(tmpdir, 'data'))
+            with open(os.path.join(tmpdir, 'READY'), 'w') as fp:
+                fp.write(str(get_tree_size(tmpdir)))
+            os.rename(tmpdir, path)
+        except OSError:
+            if not os.path.exists(os.path.join(path, 'READY')):
+                raise
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+        self.evict(keep=key)
+        return os.path.join(path, 'data')
+
+    def evict(self, keep=None):
+        if not self.max_size:
+            return
+
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            size = self.get_size(key)
+            if size is not None:
+                try:
+                    entries.append((os.stat(os.path.join(self.cache_dir, key, 'READY')).st_mtime, size, key))
+                except OSError:
+                    pass  # removed
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            elif key == keep:
+                continue
+
+            lock = FileLock(os.path.join(self.cache_dir, '%s.lock' % key))
+            if not lock.acquire(blocking=False):
+                continue  # in use by other factories
+
+            try:
+                rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+                total -= size
+            finally:
+                lock.release(unlink=True)
+
 
 class Database(object):
     DEFAULT_BOOT_TIMEOUT = 10.0
     DEFAULT_KILL_TIMEOUT = 10.0
+    DEFAULT_BOOT_POLL_INTERVAL = 0.1
+    DEFAULT_PORT_RETRIES = 3
+    DEFAULT_MEMORY_DIR = '/dev/shm'
+    DEFAULT_MEMORY_RESERVE = 256 * 1024 * 1024
+    DEFAULT_LOG_TAIL_BYTES = 64 * 1024
+    DEFAULT_LOG_TAIL_LINES = 1000
+    DEFAULT_LOG_BACKUP_COUNT = 3
     DEFAULT_SETTINGS = {}
     subdirectories = []
     terminate_signal = signal.SIGTERM
+    fast_terminate_signal = None
+    boot_ready_pattern = None
+    boot_fatal_pattern = None
+    probe_port = False
 
     def __init__(self, **kwargs):
         self.name = self.__class__.__name__
@@ -76,26 +641,56 @@ class Database(object):
         self.child_process = None
         self._owner_pid = os.getpid()
         self._use_tmpdir = False
+        self._port_reservation = None
+        self._socket_dir = None
+        self._pending_start = False
+        self.reuse_count = 0
+        self.stats = LifecycleStats()
+        self.log_capture = None
+        self.log_hooks = []
+        self._spawned_at = None
+        self._registered_pid = None
 
         if os.name == 'nt':
             self.terminate_signal = signal.CTRL_BREAK_EVENT
 
+        for pattern, callback in self.settings.get('log_hooks') or []:
+            self.add_log_hook(pattern, callback)
+
+        if self.settings.get('reap_orphans', True):
+            registry.reap_orphans_in_background()
+
         self.base_dir = self.settings.pop('base_dir')
         if self.base_dir:
             if self.base_dir[0] != '/':
                 self.base_dir = os.path.join(os.getcwd(), self.base_dir)
         else:
-            self.base_dir = tempfile.mkdtemp()
+            self.base_dir = tempfile.mkdtemp(dir=self.get_tmpdir_root())
             self._use_tmpdir = True
 
+        if is_memory_backed(self.base_dir):
+            self.placement = 'memory'
+        else:
+            self.placement = 'disk'
+
+        unix_socket = self.settings.get('unix_socket')
+        if unix_socket is True:
+            self.settings['unix_socket'] = self.get_socket_path()
+        elif unix_socket and unix_socket[0] != '/':
+            self.settings['unix_socket'] = os.path.join(os.getcwd(), unix_socket)
+
         try:
-            self.initialize()
+            with self.timing('initialize'):
+                self.initialize()
 
             if self.settings['auto_start']:
                 if self.settings['auto_start'] >= 2:
                     self.setup()
 
-                self.start()
+                if self.settings.get('lazy_start'):
+                    self._pending_start = True  # start on first access to the server
+                else:
+                    self.start()
         except Exception:
             self.cleanup()
             raise
@@ -103,146 +698,470 @@ class Database(object):
     def initialize(self):
         pass
 
+    def get_tmpdir_root(self):
+        placement = self.settings.get('base_dir_placement', 'disk')
+        if placement == 'disk':
+            return None  # $TMPDIR
+        elif placement not in ('memory', 'auto'):
+            raise ValueError('unknown base_dir_placement: %r' % placement)
+
+        memory_dir = self.settings.get('memory_dir', self.DEFAULT_MEMORY_DIR)
+        required = self.settings.get('memory_min_free')
+        if required is None:
+            required = self.DEFAULT_MEMORY_RESERVE
+            if self.settings.get('copy_data_from'):
+                size = self.settings.get('copy_data_size')
+                if size is None:
+                    size = get_tree_size(self.settings['copy_data_from'])
+                required += size
+
+        try:
+            stat = os.statvfs(memory_dir)
+            available = stat.f_bavail * stat.f_frsize
+        except (AttributeError, OSError):  # Windows or memory_dir not found
+            available = 0
+
+        if available >= required:
+            return memory_dir
+        elif placement == 'memory':
+            raise RuntimeError('not enough free space in %s: %d bytes required' % (memory_dir, required))
+        else:
+            return None
+
+    def get_socket_path(self):
+        path = os.path.join(self.base_dir, '%s.sock' % self.name.lower())
+        if len(path) > UNIX_PATH_MAX:
+            # the base_dir is too deep to place sockets; use a short temporary directory instead
+            self._socket_dir = tempfile.mkdtemp(prefix='tcd')
+            path = os.path.join(self._socket_dir, '%s.sock' % self.name.lower())
+
+        return path
+
+    @property
+    def socket_path(self):
+        return self.settings.get('unix_socket') or None
+
     def setup(self):
         # copy data files
         if self.settings['copy_data_from']:
-            try:
-                data_dir = self.get_data_directory()
-                copytree(self.settings['copy_data_from'], data_dir)
-                os.chmod(data_dir, 0o700)
-            except Exception as exc:
-                raise RuntimeError("could not copytree %s to %s: %r" %
-                                   (self.settings['copy_data_from'], data_dir, exc))
+            with self.timing('setup_copy'):
+                self.clone_data_directory(self.settings['copy_data_from'], self.get_data_directory())
 
         # create directory tree
-        for subdir in self.subdirectories:
-            path = os.path.join(self.base_dir, subdir)
-            if not os.path.exists(path):
-                os.makedirs(path)
-                os.chmod(path, 0o700)
+        with self.timing('subdirs'):
+            for subdir in self.subdirectories:
+                path = os.path.join(self.base_dir, subdir)
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                    os.chmod(path, 0o700)
 
         try:
-            self.initialize_database()
+            with self.timing('initialize_database'):
+                self.initialize_database()
         except Exception:
             self.cleanup()
             raise
 
+    def clone_data_directory(self, src, dst):
+        try:
+            copied = clone_tree(src, dst,
+                                self.settings.get('copy_data_strategy', 'auto'),
+                                self.settings.get('copy_data_workers', DEFAULT_COPY_WORKERS))
+            os.chmod(dst, 0o700)
+        except Exception as exc:
+            raise RuntimeError("could not copytree %s to %s: %r" % (src, dst, exc))
+
+        metrics.record_copy(self, copied)
+
     def get_data_directory(self):
         pass
 
+    def snapshot(self, path=None):
+        if path is None:
+            path = tempfile.mkdtemp(prefix='snapshot-', dir=self.base_dir)
+            os.rmdir(path)
+
+        snapshot = Snapshot(path)
+        if self.snapshot_in_server(snapshot):
+            snapshot.in_server = True
+            return snapshot
+
+        running = self.child_process is not None
+        if running:
+            self.terminate()
+        try:
+            self.clone_data_directory(self.get_data_directory(), snapshot.path)
+        finally:
+            if running:
+                self.start()
+
+        return snapshot
+
+    def restore(self, snapshot):
+        if self.restore_in_server(snapshot):
+            return
+        elif snapshot.in_server:
+            raise RuntimeError('%s could not restore the snapshot taken in server: %s' % (self.name, snapshot.path))
+
+        running = self.child_process is not None
+        if running:
+            self.terminate()
+
+        try:
+            # move the current data aside; it is put back if cloning the snapshot fails
+            data_dir = self.get_data_directory()
+            backup_dir = tempfile.mkdtemp(prefix='.restore-', dir=os.path.dirname(data_dir))
+            backup = os.path.join(backup_dir, os.path.basename(data_dir))
+            try:
+                os.rename(data_dir, backup)
+            except OSError:
+                os.rmdir(backup_dir)
+                raise
+
+            try:
+                self.clone_data_directory(snapshot.path, data_dir)
+            except Exception:
+                rmtree(data_dir, ignore_errors=True)
+                os.rename(backup, data_dir)
+                os.rmdir(backup_dir)
+                raise
+
+            rmtree(backup_dir, ignore_errors=True)
+        finally:
+            if running:
+                self.start()
+
+    def reset(self):
+        if not self.settings.get('copy_data_from'):
+            raise RuntimeError('%s could not be reset without copy_data_from' % self.name)
+
+        self.restore(Snapshot(self.settings['copy_data_from']))
+
+    def snapshot_in_server(self, snapshot):
+        return False  # not supported
+
+    def restore_in_server(self, snapshot):
+        return False  # not supported
+
+    def get_server_version(self):
+        return None
+
     def initialize_database(self):
         pass
 
     def start(self):
+        self._pending_start = False
         if self.child_process:
             return  # already started
 
-        self.prestart()
+        self.spawn()
+        self.wait_started()
+
+    def spawn(self):
+        with self.timing('prestart'):
+            self.prestart()
+
+        logfile = os.path.join(self.base_dir, '%s.log' % self.name)
+        if self.settings.get('capture_log') or self.log_hooks:
+            logger = None
+            stdout, stderr = subprocess.PIPE, subprocess.STDOUT
+            self.log_capture = LogCapture(logfile,
+                                          self.settings.get('log_tail_lines', self.DEFAULT_LOG_TAIL_LINES),
+                                          self.settings.get('log_max_bytes'),
+                                          self.settings.get('log_backup_count', self.DEFAULT_LOG_BACKUP_COUNT))
+            if self.log_hooks:
+                self.log_capture.add_listener(log_hook_dispatcher(self))
+        else:
+            logger = stdout = stderr = open(logfile, 'wt')
+            self.log_capture = None
 
-        logger = open(os.path.join(self.base_dir, '%s.log' % self.name), 'wt')
         try:
+            self._spawned_at = clock()
             command = self.get_server_commandline()
-            flags = 0
-            if os.name == 'nt':
-                flags |= subprocess.CREATE_NEW_PROCESS_GROUP
-            self.child_process = subprocess.Popen(command, stdout=logger, stderr=logger,
-                                                  creationflags=flags)
+            options = get_popen_options()
+            with self.timing('spawn'):
+                self.child_process = subprocess.Popen(command, stdout=stdout, stderr=stderr, **options)
+            self.register_process()
+            if self.log_capture:
+                self.log_capture.start(self.child_process.stdout)
         except Exception as exc:
+            if self.log_capture:
+                self.log_capture.close()
+            self.release_port()
+            self.record_boot(failed=True)
             raise RuntimeError('failed to launch %s: %r' % (self.name, exc))
-        else:
-            try:
-                self.wait_booting()
+        finally:
+            if logger:
+                logger.close()
+
+    def wait_started(self):
+        retries = self.settings.get('port_retries', self.DEFAULT_PORT_RETRIES)
+        try:
+            while True:
+                try:
+                    with self.timing('readiness'):
+                        self.wait_booting()
+                    break
+                except RuntimeError:
+                    if retries <= 0 or not self.is_port_collided():
+                        raise
+
+                # another process took the port; retry with a new one
+                retries -= 1
+                self.terminate()
+                self.release_port()
+                self.settings['port'] = None
+                self.spawn()
+
+            with self.timing('poststart'):
                 self.poststart()
-            except Exception:
-                self.stop()
-                raise
+        except Exception:
+            self.record_boot(failed=True)  # unless spawn() has already recorded it
+            self.stop()
+            raise
         finally:
-            logger.close()
+            self.release_port()
+
+        self.record_boot()
+
+    def record_boot(self, failed=False):
+        # record each boot to metrics only once
+        if self._spawned_at is not None:
+            metrics.record_boot(self, clock() - self._spawned_at, failed=failed)
+            self._spawned_at = None
 
     def get_server_commandline(self):
         raise NotImplemented
 
     def wait_booting(self):
         boot_timeout = self.settings.get('boot_timeout', self.DEFAULT_BOOT_TIMEOUT)
-        exec_at = datetime.now()
-        while True:
-            if self.child_process.poll() is not None:
-                raise RuntimeError("*** failed to launch %s ***\n" % self.name +
-                                   self.read_bootlog())
+        backoff = Backoff(maximum=self.settings.get('boot_poll_interval', self.DEFAULT_BOOT_POLL_INTERVAL))
+        watcher = ReadinessWatcher(os.path.join(self.base_dir, '%s.log' % self.name),
+                                   self.settings.get('boot_ready_pattern', self.boot_ready_pattern),
+                                   fatal_pattern=self.settings.get('boot_fatal_pattern', self.boot_fatal_pattern),
+                                   capture=self.log_capture,
+                                   process=self.child_process)
+        deadline = Deadline(boot_timeout)
+        try:
+            while True:
+                if self.child_process.poll() is not None:
+                    if self.log_capture:
+                        self.log_capture.drain()  # read the last output of the server
+                    raise RuntimeError("*** failed to launch %s (exit status: %d) ***\n" %
+                                       (self.name, self.child_process.returncode) +
+                                       self.read_bootlog())
 
-            if self.is_server_available():
-                break
+                if watcher.is_ready():
+                    break
+
+                if watcher.failure:
+                    raise RuntimeError("*** failed to launch %s (%s) ***\n" % (self.name, watcher.failure) +
+                                       self.read_bootlog())
+
+                if self.probe_server():
+                    break
+
+                if deadline.expired():
+                    raise RuntimeError("*** failed to launch %s (timeout) ***\n" % self.name +
+                                       self.read_bootlog())
+
+                watcher.wait(deadline.cap(next(backoff)))
+        finally:
+            watcher.close()
 
-            if (datetime.now() - exec_at).seconds > boot_timeout:
-                raise RuntimeError("*** failed to launch %s (timeout) ***\n" % self.name +
-                                   self.read_bootlog())
+    def probe_server(self):
+        if self.settings.get('probe_port', self.probe_port) and not self.is_port_listening():
+            return False  # skip expensive checks until the server starts listening
 
-            sleep(0.1)
+        return self.is_server_available()
+
+    def is_port_listening(self):
+        if self.socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.socket_path
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = ('localhost', self.settings['port'])
+
+        try:
+            sock.settimeout(1.0)
+            sock.connect(address)
+            return True
+        except socket.error:
+            return False
+        finally:
+            sock.close()
 
     def prestart(self):
-        if self.settings['port'] is None:
-            self.settings['port'] = get_unused_port()
+        if self.settings['port'] is None and not self.socket_path:
+            self._port_reservation = reserve_port()
+            self.settings['port'] = self._port_reservation.port
+
+    def release_port(self):
+        if self._port_reservation:
+            self._port_reservation.release()
+            self._port_reservation = None
+
+    def is_port_collided(self):
+        if self._port_reservation is None:
+            return False  # the port is given by user
+
+        if re.search('address already in use', self.read_bootlog(), re.I):
+            return True
+
+        return self.child_process.poll() is not None and not is_port_available(self.settings['port'])
 
     def poststart(self):
         pass
 
+    def add_log_hook(self, pattern, callback):
+        self.log_hooks.append((compile_pattern(pattern), callback))
+
+    def handle_log_line(self, line):
+        for pattern, callback in self.log_hooks:
+            match = pattern.search(line)
+            if match:
+                callback(self, line, match)
+
     def is_server_available(self):
         return False
 
     def is_alive(self):
         return self.child_process and self.child_process.poll() is None
 
+    def ensure_started(self):
+        if self._pending_start:
+            self.start()
+
     @property
     def server_pid(self):
+        self.ensure_started()
         return getattr(self.child_process, 'pid', None)
 
+    @property
+    def port(self):
+        self.ensure_started()
+        return self.settings['port']
+
     def stop(self, _signal=signal.SIGTERM):
+        if self.settings.get('background_stop'):
+            reaper.reap(self, _signal)
+            return
+
         try:
             self.terminate(_signal)
         finally:
             self.cleanup()
 
     def terminate(self, _signal=None):
+        self._pending_start = False
+        self.release_port()
         if self.child_process is None:
             return  # not started
 
         if self._owner_pid != os.getpid():
             return  # could not stop in child process
 
-        if _signal is None:
-            _signal = self.terminate_signal
-
-        try:
-            self.child_process.send_signal(_signal)
-            killed_at = datetime.now()
-            while self.child_process.poll() is None:
-                if (datetime.now() - killed_at).seconds > self.DEFAULT_KILL_TIMEOUT:
-                    self.child_process.kill()
-                    raise RuntimeError("*** failed to shutdown postgres (timeout) ***\n" + self.read_bootlog())
+        strategy, _signal, kill_timeout = self.get_shutdown_options(_signal)
+        with self.timing('terminate'):
+            try:
+                if strategy == 'immediate':
+                    kill_process(self.child_process)
+                    wait_process(self.child_process, Deadline(kill_timeout))
+                else:
+                    self.child_process.send_signal(_signal)
+                    if not wait_process(self.child_process, Deadline(kill_timeout)):
+                        kill_process(self.child_process)
+                        if strategy == 'graceful':
+                            raise RuntimeError("*** failed to shutdown %s (timeout) ***\n" % self.name +
+                                               self.read_bootlog())
 
-                sleep(0.1)
-        except OSError:
-            pass
+                        wait_process(self.child_process, Deadline(kill_timeout))
+            except OSError:
+                pass
 
         self.child_process = None
 
+    def get_shutdown_options(self, _signal=None):
+        strategy = self.settings.get('shutdown_strategy', 'graceful')
+        kill_timeout = self.settings.get('kill_timeout', self.DEFAULT_KILL_TIMEOUT)
+        if strategy == 'graceful':
+            if _signal is None:
+                _signal = self.terminate_signal
+        elif strategy == 'fast':
+            _signal = self.fast_terminate_signal or self.terminate_signal
+        elif strategy != 'immediate':
+            raise ValueError('unknown shutdown_strategy: %r' % strategy)
+
+        return strategy, _signal, kill_timeout
+
     def cleanup(self):
+        self.release_port()
         if self.child_process is not None:
             return
 
-        if self._use_tmpdir and os.path.exists(self.base_dir):
-            rmtree(self.base_dir, ignore_errors=True)
-            self._use_tmpdir = False
+        if self.log_capture:
+            self.log_capture.close()
+
+        with self.timing('cleanup'):
+            if self._use_tmpdir and os.path.exists(self.base_dir):
+                deferred_cleanup = self.settings.get('deferred_cleanup')
+                if deferred_cleanup:
+                    remove_tree_later(self.base_dir, at_exit=(deferred_cleanup == 'atexit'))
+                else:
+                    rmtree(self.base_dir, ignore_errors=True)
+                self._use_tmpdir = False
+
+            if self._socket_dir:
+                rmtree(self._socket_dir, ignore_errors=True)
+                self._socket_dir = None
+
+        self.unregister_process()
+
+    def register_process(self):
+        # record the server to the registry to reap it if this process is killed
+        self.unregister_process()
+        if self._use_tmpdir:
+            directories = [self.base_dir, self._socket_dir]
+        else:
+            directories = [self._socket_dir]
+
+        if registry.register(self.child_process.pid, self._owner_pid, self.name, directories):
+            self._registered_pid = self.child_process.pid
+
+    def unregister_process(self):
+        if self._registered_pid is not None:
+            registry.unregister(self._registered_pid)
+            self._registered_pid = None
+
+    @contextmanager
+    def timing(self, phase):
+        started_at = clock()
+        try:
+            yield
+        finally:
+            elapsed = clock() - started_at
+            self.stats.add(phase, elapsed)
+            metrics.record_phase(self, phase, elapsed)
+
+            callback = self.settings.get('on_timing')
+            if callback:
+                callback(self, phase, elapsed)
 
     def read_bootlog(self):
+        if self.log_capture:
+            return self.log_capture.tail()
+
         try:
-            with open(os.path.join(self.base_dir, '%s.log' % self.name)) as log:
-                return log.read()
+            return read_tail(os.path.join(self.base_dir, '%s.log' % self.name),
+                             self.settings.get('log_tail_bytes', self.DEFAULT_LOG_TAIL_BYTES))
         except Exception as exc:
             raise RuntimeError("failed to open file:%s.log: %r" % (self.name, exc))
 
     def __del__(self):
         try:
+            if self.child_process is not None:
+                metrics.record_leak(self)  # not stopped explicitly
             self.stop()
         except Exception:
             errmsg = ('ERROR: testing.common.database: failed to shutdown the server automatically.\n'
@@ -260,14 +1179,542 @@ class Database(object):
     def __exit__(self, *args):
         self.stop()
 
+    # asyncio interfaces (Python 3.5+)
+    def astart(self):
+        from testing.common import aiodatabase
+        return aiodatabase.start(self)
 
-class SkipIfNotInstalledDecorator(object):
-    name = ''
+    def astop(self, _signal=signal.SIGTERM):
+        from testing.common import aiodatabase
+        return aiodatabase.stop(self, _signal)
 
-    def search_server(self):
-        pass  # raise exception if not found
+    def __aenter__(self):
+        from testing.common import aiodatabase
+        return aiodatabase.enter(self)
 
-    def __call__(self, arg=None):
+    def __aexit__(self, *args):
+        return self.astop()
+
+
+class Backoff(object):
+    def __init__(self, initial=0.005, maximum=0.1, factor=1.5):
+        self.interval = min(initial, maximum)
+        self.maximum = maximum
+        self.factor = factor
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        interval = self.interval
+        self.interval = min(self.interval * self.factor, self.maximum)
+        return interval
+
+    next = __next__  # for Python 2.7
+
+
+class Deadline(object):
+    # monotonic deadline of a phase; waits in the phase are capped by its remaining time
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        if timeout is None:
+            self.expires_at = None
+        else:
+            self.expires_at = clock() + timeout
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        else:
+            return max(self.expires_at - clock(), 0.0)
+
+    def expired(self):
+        return self.expires_at is not None and clock() >= self.expires_at
+
+    def cap(self, timeout):
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        elif timeout is None:
+            return remaining
+        else:
+            return min(timeout, remaining)
+
+    def __repr__(self):
+        return '<Deadline remaining=%r>' % self.remaining()
+
+
+class ReadinessWatcher(object):
+    def __init__(self, logfile, pattern=None, notify=True, fatal_pattern=None, capture=None, process=None):
+        self.logfile = logfile
+        self.offset = 0
+        self.lastline = ''
+        self.matched = False
+        self.failure = None
+        self.pattern = compile_pattern(pattern)
+        self.fatal_pattern = compile_pattern(fatal_pattern)
+
+        # read lines from the pipe directly if captured; otherwise tail the log file
+        self.capture = capture
+        self.inotify = None
+        self.pidfd = None
+        if capture:
+            capture.add_listener(self.feed, replay=True)
+        elif notify:
+            try:
+                self.inotify = Inotify(logfile)
+            except (OSError, AttributeError):
+                pass
+
+        if process is not None and (capture or notify):
+            self.pidfd = pidfd_open(process.pid)
+
+    def is_ready(self):
+        if self.capture or (self.pattern is None and self.fatal_pattern is None) or self.matched:
+            return self.matched
+
+        try:
+            with open(self.logfile, 'rb') as fp:
+                if os.fstat(fp.fileno()).st_size < self.offset:
+                    self.offset = 0  # rotated
+                fp.seek(self.offset)
+                chunk = fp.read()
+                self.offset += len(chunk)
+        except (IOError, OSError):
+            return False
+
+        # keep the last (maybe incomplete) line only to match patterns across chunks
+        lines = (self.lastline + chunk.decode('utf-8', 'replace')).split('\n')
+        self.lastline = lines.pop()
+        for line in lines:
+            self.feed(line)
+        return self.matched
+
+    def feed(self, line):
+        if self.pattern and self.pattern.search(line):
+            self.matched = True
+        if self.fatal_pattern and self.failure is None and self.fatal_pattern.search(line):
+            self.failure = line.strip()
+
+    def wait(self, timeout):
+        if self.capture and not self.capture.eof:
+            self.capture.wait(timeout)  # wake up as soon as the server writes a line (or closes the pipe)
+            return
+
+        # wake up as soon as the server writes its log or exits
+        fds = [fd for fd in (self.inotify and self.inotify.fd, self.pidfd) if fd is not None]
+        if fds:
+            readable = select.select(fds, [], [], timeout)[0]
+            if self.inotify and self.inotify.fd in readable:
+                self.inotify.discard_events()
+        else:
+            sleep(timeout)
+
+    def close(self):
+        if self.capture:
+            self.capture.remove_listener(self.feed)
+            self.capture = None
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+
+class LogCapture(object):
+    # Reads output of the server through a pipe; keeps the last lines in memory,
+    # writes all of them into the log file (with rotation) and passes them to listeners
+
+    def __init__(self, path, tail_lines=1000, max_bytes=None, backup_count=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lines = deque(maxlen=tail_lines)
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.updated = threading.Event()
+        self.file = open(path, 'wb')
+        self.reader = None
+        self.eof = False
+
+    def add_listener(self, listener, replay=False):
+        with self.lock:
+            if replay:
+                for line in self.lines:
+                    listener(line)
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def start(self, stream):
+        self.reader = threading.Thread(target=self.run, args=(stream,))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def run(self, stream):
+        try:
+            for line in iter(lambda: stream.readline(65536), b''):
+                try:
+                    self.feed(line)
+                except Exception:
+                    pass  # keep reading the pipe not to block the server
+        except Exception:
+            pass  # the pipe is broken
+        finally:
+            stream.close()
+            with self.lock:
+                self.file.close()
+            self.eof = True
+            self.updated.set()
+
+    def feed(self, line):
+        text = line.decode('utf-8', 'replace')
+        with self.lock:
+            self.lines.append(text)
+            listeners = list(self.listeners)
+            if not self.file.closed:
+                self.file.write(line)
+                self.file.flush()
+                if self.max_bytes and self.file.tell() >= self.max_bytes:
+                    self.rotate()
+
+        for listener in listeners:
+            try:
+                listener(text)
+            except Exception:
+                pass  # errors in hooks should not stop reading the pipe
+        self.updated.set()
+
+    def wait(self, timeout):
+        self.updated.wait(timeout)
+        self.updated.clear()
+
+    def drain(self, timeout=1.0):
+        if self.reader:
+            self.reader.join(timeout)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.rename('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+
+        if self.backup_count > 0:
+            os.rename(self.path, '%s.1' % self.path)
+        self.file = open(self.path, 'wb')
+
+    def tail(self):
+        with self.lock:
+            return ''.join(self.lines)
+
+    def close(self):
+        if self.reader:
+            self.reader.join(1.0)
+
+        with self.lock:
+            self.file.close()
+
+
+class Inotify(object):
+    IN_MODIFY = 0x00000002
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, path):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported on this platform')
+
+        libc = get_libc()
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+
+        if libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding()), self.IN_MODIFY) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch() failed: %s' % path)
+
+    def discard_events(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Reaper(object):
+    def __init__(self):
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.closed = False
+        self.pending_trash = set()
+        self.trash_at_exit = set()
+        self.trash = {}  # trash_dir -> names moved into it by this process
+
+    def reap(self, instance, _signal=None):
+        self.submit(self.stop_instance, instance, _signal)
+
+    def empty_trash(self, trash_dir, name, at_exit=False):
+        with self.lock:
+            self.trash.setdefault(trash_dir, set()).add(name)
+            if at_exit and not self.closed:
+                self.trash_at_exit.add(trash_dir)
+                self.start_worker()
+                return
+            elif trash_dir in self.pending_trash:
+                return  # the trash will be emptied soon with other directories
+
+            self.pending_trash.add(trash_dir)
+
+        self.submit(self.remove_trash, trash_dir)
+
+    def submit(self, func, *args):
+        with self.lock:
+            self.start_worker()
+
+        if self.closed:  # interpreter is shutting down; run it in foreground
+            func(*args)
+        else:
+            self.queue.put((func, args))
+
+    def start_worker(self):
+        if not self.closed and self.worker is None:
+            self.worker = threading.Thread(target=self.run)
+            self.worker.daemon = True
+            self.worker.start()
+            atexit.register(self.close)
+
+    def run(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception as exc:
+                sys.__stderr__.write('ERROR: testing.common.database: failed to cleanup in background: %r\n' % exc)
+            finally:
+                self.queue.task_done()
+
+    def stop_instance(self, instance, _signal):
+        try:
+            instance.terminate(_signal)
+        finally:
+            instance.cleanup()
+
+    def remove_trash(self, trash_dir):
+        with self.lock:
+            self.pending_trash.discard(trash_dir)
+            names = self.trash.pop(trash_dir, set())
+
+        for name in names:
+            rmtree(os.path.join(trash_dir, name), ignore_errors=True)
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.closed = True
+            trash_at_exit, self.trash_at_exit = self.trash_at_exit, set()
+
+        for trash_dir in trash_at_exit:
+            self.remove_trash(trash_dir)
+
+
+reaper = Reaper()
+
+
+class ProcessRegistry(object):
+    # per-user registry of running servers (a JSON file for each server);
+    # servers whose owner processes have gone are killed on the next run
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.swept = False
+
+    def get_path(self):
+        if self.path is None:
+            self.path = get_runtime_dir('processes')
+        return self.path
+
+    def register(self, pid, owner_pid, name, directories):
+        started_at = get_process_start_time(pid)
+        owner_started_at = get_process_start_time(owner_pid)
+        if started_at is None or owner_started_at is None:
+            return False  # not supported; reused pids could not be detected without start times
+
+        entry = dict(pid=pid, started_at=started_at, owner_pid=owner_pid, owner_started_at=owner_started_at,
+                     name=name, directories=[path for path in directories if path])
+        try:
+            path = os.path.join(self.get_path(), '%d.json' % pid)
+            with open(path + '.tmp', 'w') as fp:
+                json.dump(entry, fp)
+            os.rename(path + '.tmp', path)
+            return True
+        except (OSError, IOError, RuntimeError):
+            return False  # the registry is not available; only reaping is disabled
+
+    def unregister(self, pid):
+        try:
+            os.unlink(os.path.join(self.get_path(), '%d.json' % pid))
+        except (OSError, RuntimeError):
+            pass
+
+    def entries(self):
+        try:
+            names = os.listdir(self.get_path())
+        except (OSError, RuntimeError):
+            return
+
+        for name in names:
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.path, name)) as fp:
+                        yield json.load(fp)
+                except (IOError, OSError, ValueError):
+                    pass  # removed or being written
+
+    def reap_orphans(self, kill_timeout=Database.DEFAULT_KILL_TIMEOUT):
+        reaped = []
+        try:
+            lock = FileLock(os.path.join(self.get_path(), '.lock'))
+        except RuntimeError:
+            return reaped
+
+        if not lock.acquire(blocking=False):
+            return reaped  # another process is reaping
+
+        try:
+            for entry in self.entries():
+                if entry.get('started_at') is None or entry.get('owner_started_at') is None:
+                    continue  # could not identify the processes
+                elif is_process_running(entry['owner_pid'], entry['owner_started_at']):
+                    continue
+
+                kill_process_group(entry['pid'], entry['started_at'], kill_timeout)
+                for path in entry['directories']:
+                    if is_owned_directory(path):
+                        rmtree(path, ignore_errors=True)
+                self.unregister(entry['pid'])
+                reaped.append(entry)
+        finally:
+            lock.release()
+
+        return reaped
+
+    def reap_orphans_in_background(self):
+        with self.lock:
+            if self.swept:
+                return
+            self.swept = True
+
+        if get_process_start_time(os.getpid()) is None:
+            return  # not supported on this platform
+
+        reaper.submit(self.reap_orphans)
+
+
+registry = ProcessRegistry()
+
+
+def reap_orphans(kill_timeout=Database.DEFAULT_KILL_TIMEOUT):
+    return registry.reap_orphans(kill_timeout)
+
+
+def remove_tree_later(path, at_exit=False):
+    # move the directory into a trash directory on the same filesystem (O(1) rename),
+    # and remove it in background (or at exit)
+    trash_dir = get_trash_dir(path)
+    if trash_dir:
+        name = os.path.basename(path)
+        try:
+            os.rename(path, os.path.join(trash_dir, name))
+            reaper.empty_trash(trash_dir, name, at_exit)
+            return
+        except OSError:
+            pass
+
+    rmtree(path, ignore_errors=True)
+
+
+def get_trash_dir(path):
+    parent = os.path.dirname(path)
+    try:
+        trash_dir = get_runtime_dir('trash')
+        if os.stat(trash_dir).st_dev == os.stat(parent).st_dev and is_private_directory(trash_dir):
+            return trash_dir
+    except (OSError, RuntimeError):
+        pass
+
+    # the parent might be shared with other users (ex. /tmp); never trust a directory created by others
+    trash_dir = os.path.join(parent, '.testing.common.database-trash-%s' % getpass.getuser())
+    try:
+        os.mkdir(trash_dir, 0o700)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            return None
+
+    if is_private_directory(trash_dir):
+        return trash_dir
+    else:
+        return None
+
+
+def is_private_directory(path):
+    if not hasattr(os, 'getuid'):
+        return False  # Windows; ownership could not be checked
+
+    try:
+        return is_owned_directory(path) and os.lstat(path).st_mode & 0o777 == 0o700
+    except OSError:
+        return False
+
+
+def log_hook_dispatcher(database):
+    # refers the database weakly not to keep it alive from the reader thread (for __del__)
+    ref = weakref.ref(database)
+
+    def dispatch(line):
+        database = ref()
+        if database is not None:
+            database.handle_log_line(line)
+
+    return dispatch
+
+
+def compile_pattern(pattern):
+    if isinstance(pattern, string_types):
+        return re.compile(pattern)
+    else:
+        return pattern
+
+
+def start_on_access(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.ensure_started()
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class SkipIfNotInstalledDecorator(object):
+    name = ''
+
+    def search_server(self):
+        pass  # raise exception if not found
+
+    def __call__(self, arg=None):
         if sys.version_info < (2, 7):
             from unittest2 import skipIf
         else:
@@ -300,6 +1747,316 @@ def get_unused_port():
     return port
 
 
+def is_memory_backed(path):
+    try:
+        with open('/proc/mounts') as fp:
+            mounts = [line.split()[1:3] for line in fp]
+    except (IOError, OSError):
+        return False  # not Linux
+
+    path = os.path.realpath(path)
+    fstype = None
+    longest = -1
+    for mountpoint, _fstype in mounts:
+        mountpoint = mountpoint.replace('\\040', ' ')
+        if path == mountpoint or path.startswith(mountpoint.rstrip('/') + '/'):
+            if len(mountpoint) > longest:
+                fstype = _fstype
+                longest = len(mountpoint)
+
+    return fstype in ('tmpfs', 'ramfs')
+
+
+def read_tail(path, size):
+    with open(path, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        if fp.tell() > size:
+            fp.seek(-size, os.SEEK_END)
+            fp.readline()  # skip the partial line
+        else:
+            fp.seek(0)
+
+        return fp.read().decode('utf-8', 'replace')
+
+
+def get_tree_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+
+    return size
+
+
+def is_port_available(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('localhost', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def reserve_port(retries=100):
+    # Reserve an unused port with a lock file until the server binds it.
+    # It prevents other processes (ex. pytest-xdist workers) from choosing the same port.
+    for _ in range(retries):
+        port = get_unused_port()
+        lock = FileLock(os.path.join(get_runtime_dir('ports'), '%d.lock' % port))
+        if lock.acquire(blocking=False):
+            return PortReservation(port, lock)
+
+    raise RuntimeError('could not reserve an unused port')
+
+
+class PortReservation(object):
+    def __init__(self, port, lock):
+        self.port = port
+        self.lock = lock
+
+    def release(self):
+        self.lock.release(unlink=True)
+
+
+class FileLock(object):
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, blocking=True, timeout=None, shared=False):
+        if fcntl is None:  # Windows; locking is not supported
+            return True
+
+        if timeout is not None:
+            deadline = Deadline(timeout)
+            for interval in Backoff(maximum=0.5):
+                if self.acquire(blocking=False, shared=shared):
+                    return True
+                elif deadline.expired():
+                    return False
+
+                sleep(deadline.cap(interval))
+
+        if shared:
+            flags = fcntl.LOCK_SH
+        else:
+            flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, flags)
+            except (IOError, OSError) as exc:
+                os.close(fd)
+                if exc.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+
+            # the previous owner might have removed the lock file before we locked it
+            try:
+                if os.path.samestat(os.stat(self.path), os.fstat(fd)):
+                    self.fd = fd
+                    return True
+            except OSError:
+                pass
+
+            os.close(fd)
+
+    def release(self, unlink=False):
+        if self.fd is not None:
+            if unlink:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        if self.fd is None:
+            self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def get_runtime_dir(*subdirs):
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        basedir = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'testing.common.database')
+    else:
+        basedir = os.path.join(tempfile.gettempdir(), 'testing.common.database-%s' % getpass.getuser())
+
+    path = os.path.join(basedir, *subdirs)
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+    if hasattr(os, 'getuid') and not is_owned_directory(basedir):
+        raise RuntimeError('runtime directory %s is owned by other user' % basedir)
+
+    return path
+
+
+def wait_process(process, deadline):
+    if not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)  # timeout in seconds
+
+    if process.poll() is not None:
+        return True
+
+    pidfd = pidfd_open(process.pid)
+    if pidfd is not None:
+        try:
+            remaining = deadline.remaining()
+            poller = select.poll()
+            poller.register(pidfd, select.POLLIN)
+            poller.poll(None if remaining is None else remaining * 1000)  # readable when the process exits
+        finally:
+            os.close(pidfd)
+        return process.poll() is not None
+    elif sys.version_info >= (3, 3):
+        try:
+            process.wait(deadline.remaining())
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+    else:
+        for interval in Backoff():
+            if process.poll() is not None:
+                return True
+            elif deadline.expired():
+                return False
+
+            sleep(deadline.cap(interval))
+
+
+def get_popen_options():
+    # start servers in their own process group (session) to kill them with their children
+    if os.name == 'nt':
+        return dict(creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+    elif sys.version_info >= (3, 2):
+        return dict(start_new_session=True)
+    else:
+        return dict(preexec_fn=os.setsid)
+
+
+def kill_process(process):
+    # kill the server with its children; it is a leader of its own process group
+    if os.name != 'nt' and process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
+
+    process.kill()
+
+
+def kill_process_group(pgid, started_at, timeout):
+    # kill the process group only if its leader is the very process started at ``started_at``;
+    # never signal processes which could not be identified (ex. the pid is reused)
+    def is_leader_running():
+        return (started_at is not None and is_process_running(pgid, started_at) and
+                os.getpgid(pgid) == pgid)
+
+    try:
+        if not is_leader_running():
+            return
+
+        os.killpg(pgid, signal.SIGTERM)
+        deadline = Deadline(timeout)
+        for interval in Backoff():
+            if not is_leader_running():
+                return
+            elif deadline.expired():
+                os.killpg(pgid, signal.SIGKILL)
+                return
+
+            sleep(deadline.cap(interval))
+    except OSError:
+        pass  # already exited
+
+
+def is_owned_directory(path):
+    try:
+        stat = os.lstat(path)
+        return os.path.isdir(path) and not os.path.islink(path) and stat.st_uid == os.getuid()
+    except OSError:
+        return False
+
+
+def get_process_stat(pid):
+    # fields of /proc/<pid>/stat after the command name (state, ppid, ...); Linux only
+    try:
+        with open('/proc/%d/stat' % pid) as fp:
+            stat = fp.read()
+        return stat[stat.rindex(')') + 2:].split()
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_process_start_time(pid):
+    # start time of the process (in clock ticks since boot) to detect reuse of pids
+    stat = get_process_stat(pid)
+    if stat and len(stat) > 19:
+        return int(stat[19])
+    else:
+        return None
+
+
+def is_process_running(pid, started_at=None):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        if exc.errno != errno.EPERM:
+            return False
+
+    stat = get_process_stat(pid)
+    if stat and stat[0] in ('Z', 'X'):
+        return False  # exited, but not reaped yet
+    elif started_at is not None and get_process_start_time(pid) != started_at:
+        return False  # the pid is reused by other process
+
+    return True
+
+
+def get_libc():
+    global libc
+    if libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+    return libc
+
+
+def pidfd_open(pid):
+    # returns a file descriptor which gets readable when the process exits (Linux 5.3+)
+    if hasattr(os, 'pidfd_open'):  # Python 3.9+
+        try:
+            return os.pidfd_open(pid)
+        except OSError:
+            return None
+    elif sys.platform.startswith('linux'):
+        try:
+            pidfd = get_libc().syscall(SYS_PIDFD_OPEN, pid, 0)
+            if pidfd >= 0:
+                return pidfd
+        except (OSError, AttributeError):
+            pass
+
+    return None
+
+
 def get_path_of(name):
     if os.name == 'nt':
         which = 'where'
@@ -315,3 +2072,136 @@ def get_path_of(name):
             return None
     except Exception:
         return None
+
+
+def reflink_file(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported on this platform')
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    copystat(src, dst)
+
+
+def link_file(src, dst):
+    os.link(os.path.realpath(src), dst)  # os.link() does not follow symlinks on some platforms
+
+
+def copy_file(src, dst):
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            _copy_fileobj(fsrc, fdst)
+    copystat(src, dst)
+
+
+def _copy_fileobj(fsrc, fdst):
+    # copy_file_range(2) and sendfile(2) copy data inside the kernel; both advance
+    # the file offsets, so a fallback can continue from where they stopped.
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+    try:
+        if hasattr(os, 'copy_file_range'):
+            while os.copy_file_range(infd, outfd, COPY_BUFSIZE):
+                pass
+            return
+        elif hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            while os.sendfile(outfd, infd, None, COPY_BUFSIZE):
+                pass
+            return
+    except OSError as exc:
+        if exc.errno not in CLONE_UNSUPPORTED_ERRORS:
+            raise
+
+    copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+class _ReflinkOrCopy(object):
+    def __init__(self):
+        self.reflink_supported = True
+
+    def __call__(self, src, dst):
+        if self.reflink_supported:
+            try:
+                return reflink_file(src, dst)
+            except (IOError, OSError) as exc:
+                if exc.errno not in CLONE_UNSUPPORTED_ERRORS:
+                    raise
+
+                self.reflink_supported = False
+                if os.path.exists(dst):
+                    os.unlink(dst)
+
+        copy_file(src, dst)
+
+
+def clone_tree(src, dst, strategy='auto', workers=DEFAULT_COPY_WORKERS):
+    if strategy == 'auto':
+        clone_file = _ReflinkOrCopy()
+    elif strategy == 'reflink':
+        clone_file = reflink_file
+    elif strategy == 'hardlink':
+        # shares inodes with *src*; only safe for servers which never modify data files in place
+        clone_file = link_file
+    elif strategy == 'copy':
+        clone_file = copy_file
+    else:
+        raise ValueError('unknown copy_data_strategy: %r' % strategy)
+
+    parent = os.path.dirname(dst)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)  # like shutil.copytree()
+
+    directories = []
+    files = []
+    _scan_tree(src, dst, directories, files)
+
+    if workers > 1 and len(files) > 1:
+        pool = ThreadPool(min(workers, len(files)))
+        try:
+            pool.map(lambda args: clone_file(args[0], args[1]), files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for srcname, dstname, _ in files:
+            clone_file(srcname, dstname)
+
+    # copy the timestamps of directories after their contents are filled
+    for srcname, dstname in reversed(directories):
+        copystat(srcname, dstname)
+
+    return sum(size for _, _, size in files)
+
+
+def _scan_tree(src, dst, directories, files):
+    os.mkdir(dst)
+    directories.append((src, dst))
+    for entry in _scandir(src):
+        # follow symlinks like shutil.copytree(symlinks=False); instances should not share
+        # the linked contents (ex. tablespaces) with the template
+        srcname = entry.path
+        dstname = os.path.join(dst, entry.name)
+        if entry.is_dir():
+            _scan_tree(srcname, dstname, directories, files)
+        else:
+            files.append((srcname, dstname, entry.stat().st_size))
+
+
+class _DirEntry(object):
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _scandir(path):
+    if hasattr(os, 'scandir'):
+        return os.scandir(path)
+    else:  # Python 2.7
+        return [_DirEntry(path, name) for name in os.listdir(path)]